@@ -62,7 +62,8 @@ def main(args):
               batch_size=args.batch_size,
               learning_rate=args.learning_rate,
               learning_rate_decay=args.learning_rate_decay,
-              weight_decay=args.weight_decay)
+              weight_decay=args.weight_decay,
+              jit_compile=args.jit)
 
     # Evaluate.
     x_test, t_test, y_test, true_ite = generate_data(args)
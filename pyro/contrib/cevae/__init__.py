@@ -9,7 +9,8 @@ demonstrates a number of innovations including:
 
 The main interface is the :class:`CEVAE` class, but users may customize by
 using components :class:`Model`, :class:`Guide`,
-:class:`TraceCausalEffect_ELBO` and utilities.
+:class:`TraceCausalEffect_ELBO`, :class:`JitTraceCausalEffect_ELBO` and
+utilities.
 
 **References**
 
@@ -19,19 +20,24 @@ using components :class:`Model`, :class:`Guide`,
     | https://github.com/AMLab-Amsterdam/CEVAE
 """
 import logging
+import weakref
 
 import torch
 import torch.nn as nn
-from torch.utils.data import DataLoader, TensorDataset
+from torch.utils.data import BatchSampler, DataLoader, RandomSampler, TensorDataset
 
 import pyro
 import pyro.distributions as dist
-from pyro import poutine
+import pyro.ops.jit
+from pyro.distributions.util import is_identically_zero
 from pyro.infer import SVI, Trace_ELBO
+# _compute_log_r is private, but reusing it keeps the score function
+# estimator for non-reparametrized guide sites identical to Trace_ELBO's.
+from pyro.infer.trace_elbo import _compute_log_r
 from pyro.infer.util import torch_item
 from pyro.nn import PyroModule
 from pyro.optim import ClippedAdam
-from pyro.util import torch_isnan
+from pyro.util import optional, torch_isnan, warn_if_nan
 
 logger = logging.getLogger(__name__)
 
@@ -45,7 +51,8 @@ class FullyConnected(nn.Sequential):
         for in_size, out_size in zip(sizes, sizes[1:]):
             layers.append(nn.Linear(in_size, out_size))
             layers.append(nn.ELU())
-        layers.pop(-1)
+        if layers:
+            layers.pop(-1)
         if final_activation is not None:
             layers.append(final_activation)
         super().__init__(*layers)
@@ -219,6 +226,17 @@ class StudentTNet(DistributionNet):
         return dist.StudentT(df, loc, scale)
 
 
+@torch.jit.script
+def _diag_normal_constrain(loc, scale):
+    """
+    Conservatively clips an unconstrained ``loc,scale`` pair. This is scripted
+    so that the elementwise tail can be fused into a single kernel.
+    """
+    loc = loc.clamp(min=-1e2, max=1e2)
+    scale = torch.nn.functional.softplus(scale).add(1e-3).clamp(max=1e2)
+    return loc, scale
+
+
 class DiagNormalNet(nn.Module):
     """
     :class:`FullyConnected` network outputting a constrained ``loc,scale``
@@ -244,9 +262,8 @@ class DiagNormalNet(nn.Module):
 
     def forward(self, x):
         loc_scale = self.fc(x)
-        loc = loc_scale[..., :self.dim].clamp(min=-1e2, max=1e2)
-        scale = nn.functional.softplus(loc_scale[..., self.dim:]).add(1e-3).clamp(max=1e2)
-        return loc, scale
+        loc, scale = loc_scale.chunk(2, dim=-1)
+        return _diag_normal_constrain(loc, scale)
 
 
 class PreWhitener(nn.Module):
@@ -296,6 +313,9 @@ class Model(PyroModule):
         self.y1_nn = OutcomeNet([config["latent_dim"]] +
                                 [config["hidden_dim"]] * config["num_layers"])
         self.t_nn = BernoulliNet([config["latent_dim"]])
+        # The z prior is fixed, so we store its parameters as buffers.
+        self.register_buffer("z_loc", torch.zeros(config["latent_dim"]))
+        self.register_buffer("z_scale", torch.ones(config["latent_dim"]))
 
     def forward(self, x, t=None, y=None, size=None):
         if size is None:
@@ -315,7 +335,7 @@ class Model(PyroModule):
         return self.y_dist(t, z).mean
 
     def z_dist(self):
-        return dist.Normal(0, 1).expand([self.latent_dim]).to_event(1)
+        return dist.Normal(self.z_loc, self.z_scale).to_event(1)
 
     def x_dist(self, z):
         loc, scale = self.x_nn(z)
@@ -325,8 +345,8 @@ class Model(PyroModule):
         # Parameters are not shared among t values.
         params0 = self.y0_nn(z)
         params1 = self.y1_nn(z)
-        t = t.bool()
-        params = [torch.where(t, p1, p0) for p0, p1 in zip(params0, params1)]
+        # Since t is binary, lerp selects params without a boolean mask.
+        params = [torch.lerp(p0, p1, t.type_as(p0)) for p0, p1 in zip(params0, params1)]
         return self.y0_nn.make_dist(*params)
 
     def t_dist(self, z):
@@ -364,11 +384,20 @@ class Guide(PyroModule):
                                    final_activation=nn.ELU())
         self.y0_nn = OutcomeNet([config["hidden_dim"]])
         self.y1_nn = OutcomeNet([config["hidden_dim"]])
-        self.z_nn = FullyConnected([1 + config["feature_dim"]] +
-                                   [config["hidden_dim"]] * (config["num_layers"] - 1),
-                                   final_activation=nn.ELU())
-        self.z0_nn = DiagNormalNet([config["hidden_dim"], config["latent_dim"]])
-        self.z1_nn = DiagNormalNet([config["hidden_dim"], config["latent_dim"]])
+        # The first z layer acts on (y, x), but is split into an x part and a
+        # y part to avoid concatenating y and x. Both parts are initialized
+        # like a single Linear layer with 1 + feature_dim inputs.
+        self.z_x_nn = nn.Linear(config["feature_dim"], config["hidden_dim"])
+        self.z_y_nn = nn.Linear(1, config["hidden_dim"], bias=False)
+        bound = (1 + config["feature_dim"]) ** -0.5
+        for param in (self.z_x_nn.weight, self.z_x_nn.bias, self.z_y_nn.weight):
+            nn.init.uniform_(param, -bound, bound)
+        # The remaining shared z layers follow the ELU of the first layer.
+        self.z_nn = FullyConnected([config["hidden_dim"]] * (config["num_layers"] - 1),
+                                   final_activation=nn.ELU() if config["num_layers"] > 2 else None)
+        # The final z layers for t=0 and t=1 are stacked into a single Linear
+        # layer, whose output is laid out as (loc|scale, t, latent_dim).
+        self.z01_nn = nn.Linear(config["hidden_dim"], 4 * config["latent_dim"])
 
     def forward(self, x, t=None, y=None, size=None):
         if size is None:
@@ -392,20 +421,22 @@ class Guide(PyroModule):
         # In the final layer params are not shared among t values.
         params0 = self.y0_nn(hidden)
         params1 = self.y1_nn(hidden)
-        t = t.bool()
-        params = [torch.where(t, p1, p0) for p0, p1 in zip(params0, params1)]
+        # Since t is binary, lerp selects params without a boolean mask.
+        params = [torch.lerp(p0, p1, t.type_as(p0)) for p0, p1 in zip(params0, params1)]
         return self.y0_nn.make_dist(*params)
 
     def z_dist(self, y, t, x):
         # The first n-1 layers are identical for all t values.
-        y_x = torch.cat([y.unsqueeze(-1), x], dim=-1)
-        hidden = self.z_nn(y_x)
-        # In the final layer params are not shared among t values.
-        params0 = self.z0_nn(hidden)
-        params1 = self.z1_nn(hidden)
-        t = t.bool().unsqueeze(-1)
-        params = [torch.where(t, p1, p0) for p0, p1 in zip(params0, params1)]
-        return dist.Normal(*params).to_event(1)
+        hidden = self.z_x_nn(x) + self.z_y_nn(y.unsqueeze(-1))
+        hidden = self.z_nn(nn.functional.elu(hidden))
+        # In the final layer params are not shared among t values. We select
+        # unconstrained params with a single lerp, then constrain only those.
+        loc_scale = self.z01_nn(hidden)
+        loc_scale = loc_scale.reshape(loc_scale.shape[:-1] + (2, 2, self.latent_dim))
+        t = t.type_as(loc_scale).unsqueeze(-1).unsqueeze(-1)
+        loc_scale = torch.lerp(loc_scale[..., 0, :], loc_scale[..., 1, :], t)
+        loc, scale = _diag_normal_constrain(*loc_scale.unbind(-2))
+        return dist.Normal(loc, scale).to_event(1)
 
 
 class TraceCausalEffect_ELBO(Trace_ELBO):
@@ -415,30 +446,105 @@ class TraceCausalEffect_ELBO(Trace_ELBO):
 
         -loss = ELBO + log q(t|x) + log q(y|t,x)
     """
+    def _elbo_particle(self, model_trace, guide_trace):
+        """
+        Computes the CEVAE objective and its surrogate for a single particle,
+        as tensors. This is shared by the eager and jit loss implementations.
+        """
+        elbo = 0.
+        surrogate_elbo = 0.
+        log_r = None
+
+        for site in model_trace.nodes.values():
+            if site["type"] == "sample":
+                elbo = elbo + site["log_prob_sum"]
+                surrogate_elbo = surrogate_elbo + site["log_prob_sum"]
+
+        for site in guide_trace.nodes.values():
+            if site["type"] != "sample":
+                continue
+            if site["is_observed"]:
+                # Add log q terms, rather than subtracting them as in the ELBO.
+                elbo = elbo + site["log_prob_sum"]
+                surrogate_elbo = surrogate_elbo + site["log_prob_sum"]
+                continue
+
+            log_prob, score_function_term, entropy_term = site["score_parts"]
+            elbo = elbo - site["log_prob_sum"]
+            if not is_identically_zero(entropy_term):
+                surrogate_elbo = surrogate_elbo - entropy_term.sum()
+            if not is_identically_zero(score_function_term):
+                if log_r is None:
+                    log_r = _compute_log_r(model_trace, guide_trace)
+                log_r_term = log_r.sum_to(site["cond_indep_stack"])
+                surrogate_elbo = surrogate_elbo + (log_r_term * score_function_term).sum()
+
+        return elbo, surrogate_elbo
+
     def _differentiable_loss_particle(self, model_trace, guide_trace):
-        # Construct -ELBO part.
-        blocked_names = [name for name, site in guide_trace.nodes.items()
-                         if site["type"] == "sample" and site["is_observed"]]
-        blocked_guide_trace = guide_trace.copy()
-        for name in blocked_names:
-            del blocked_guide_trace.nodes[name]
-        loss, surrogate_loss = super()._differentiable_loss_particle(
-            model_trace, blocked_guide_trace)
-
-        # Add log q terms.
-        for name in blocked_names:
-            log_q = guide_trace.nodes[name]["log_prob_sum"]
-            loss = loss - torch_item(log_q)
-            surrogate_loss = surrogate_loss - log_q
-
-        return loss, surrogate_loss
+        elbo, surrogate_elbo = self._elbo_particle(model_trace, guide_trace)
+        return -torch_item(elbo), -surrogate_elbo
 
     @torch.no_grad()
     def loss(self, model, guide, *args, **kwargs):
         return torch_item(self.differentiable_loss(model, guide, *args, **kwargs))
 
 
-class CEVAE(nn.Module):
+class JitTraceCausalEffect_ELBO(TraceCausalEffect_ELBO):
+    """
+    Like :class:`TraceCausalEffect_ELBO` but uses :func:`pyro.ops.jit.trace`
+    to compile :meth:`loss_and_grads`.
+
+    This works only for a limited set of models, see
+    :class:`~pyro.infer.trace_elbo.JitTrace_ELBO`. Compilation is triggered
+    once per unique set of tensor argument shapes, so a smaller final
+    minibatch triggers a single extra compilation.
+    """
+    def loss_and_surrogate_loss(self, model, guide, *args, **kwargs):
+        kwargs['_pyro_model_id'] = id(model)
+        kwargs['_pyro_guide_id'] = id(guide)
+        kwargs['_pyro_arg_shapes'] = tuple(tuple(arg.shape) for arg in args
+                                           if isinstance(arg, torch.Tensor))
+        if getattr(self, '_loss_and_surrogate_loss', None) is None:
+            # build a closure for loss_and_surrogate_loss
+            weakself = weakref.ref(self)
+
+            @pyro.ops.jit.trace(ignore_warnings=self.ignore_jit_warnings,
+                                jit_options=self.jit_options)
+            def loss_and_surrogate_loss(*args, **kwargs):
+                kwargs.pop('_pyro_model_id')
+                kwargs.pop('_pyro_guide_id')
+                kwargs.pop('_pyro_arg_shapes')
+                self = weakself()
+                loss = 0.0
+                surrogate_loss = 0.0
+                for model_trace, guide_trace in self._get_traces(model, guide, args, kwargs):
+                    elbo_particle, surrogate_elbo_particle = self._elbo_particle(model_trace, guide_trace)
+                    loss = loss - elbo_particle / self.num_particles
+                    surrogate_loss = surrogate_loss - surrogate_elbo_particle / self.num_particles
+
+                return loss, surrogate_loss
+
+            self._loss_and_surrogate_loss = loss_and_surrogate_loss
+
+        return self._loss_and_surrogate_loss(*args, **kwargs)
+
+    def differentiable_loss(self, model, guide, *args, **kwargs):
+        loss, surrogate_loss = self.loss_and_surrogate_loss(model, guide, *args, **kwargs)
+
+        warn_if_nan(loss, "loss")
+        return loss + (surrogate_loss - surrogate_loss.detach())
+
+    def loss_and_grads(self, model, guide, *args, **kwargs):
+        loss, surrogate_loss = self.loss_and_surrogate_loss(model, guide, *args, **kwargs)
+        surrogate_loss.backward()
+        loss = loss.item()
+
+        warn_if_nan(loss, "loss")
+        return loss
+
+
+class CEVAE(PyroModule):
     """
     Main class implementing a Causal Effect VAE [1]. This assumes a graphical model
 
@@ -492,6 +598,9 @@ class CEVAE(nn.Module):
         self.num_samples = num_samples
 
         super().__init__()
+        # As PyroModule children, the model and guide nets are registered in
+        # the param store under distinct "model." and "guide." prefixes.
+        # Their t_nn, y0_nn and y1_nn nets would otherwise share names.
         self.model = Model(config)
         self.guide = Guide(config)
 
@@ -500,7 +609,10 @@ class CEVAE(nn.Module):
             batch_size=100,
             learning_rate=1e-3,
             learning_rate_decay=0.1,
-            weight_decay=1e-4):
+            weight_decay=1e-4,
+            jit_compile=False,
+            num_workers=0,
+            amp=False):
         """
         Train using :class:`~pyro.infer.svi.SVI` with the
         :class:`TraceCausalEffect_ELBO` loss.
@@ -517,26 +629,55 @@ class CEVAE(nn.Module):
             learning rate will be ``learning_rate * learning_rate_decay``.
             Defaults to 0.1.
         :param float weight_decay: Weight decay. Defaults to 1e-4.
+        :param bool jit_compile: Whether to compile the loss using
+            :class:`JitTraceCausalEffect_ELBO`. This traces the model and guide
+            networks into a single TorchScript graph, allowing PyTorch to fuse
+            their elementwise operations. Defaults to False.
+        :param int num_workers: Number of worker processes used to prefetch
+            minibatches of CPU data, see :class:`~torch.utils.data.DataLoader`.
+            Defaults to 0, i.e. batches are loaded in the main process.
+        :param bool amp: Whether to train under :class:`torch.autocast` with
+            ``bfloat16`` mixed precision; parameters and optimizer state remain
+            in full precision. This requires PyTorch 1.10 or later.
+            Defaults to False.
         :return: list of epoch losses
         """
         assert x.dim() == 2 and x.size(-1) == self.feature_dim
         assert t.shape == x.shape[:1]
         assert y.shape == y.shape[:1]
+        if num_workers > 0 and x.is_cuda:
+            raise ValueError("num_workers > 0 is only supported for CPU data, but x is on {}"
+                             .format(x.device))
+        if amp and not hasattr(torch, "autocast"):
+            raise ValueError("amp=True requires torch.autocast (PyTorch >= 1.10)")
         self.whiten = PreWhitener(x)
 
         dataset = TensorDataset(x, t, y)
-        dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=True)
+        # Index whole minibatches at once rather than collating single rows.
+        sampler = BatchSampler(RandomSampler(dataset), batch_size=batch_size, drop_last=False)
+        dataloader = DataLoader(dataset, sampler=sampler, batch_size=None,
+                                num_workers=num_workers)
         logger.info("Training with {} minibatches per epoch".format(len(dataloader)))
         num_steps = num_epochs * len(dataloader)
         optim = ClippedAdam({"lr": learning_rate,
                              "weight_decay": weight_decay,
                              "lrd": learning_rate_decay ** (1 / num_steps)})
-        svi = SVI(self.model, self.guide, optim, TraceCausalEffect_ELBO())
+        if jit_compile:
+            loss_fn = JitTraceCausalEffect_ELBO(ignore_jit_warnings=True)
+        else:
+            loss_fn = TraceCausalEffect_ELBO()
+        svi = SVI(self.model, self.guide, optim, loss_fn)
+        if amp:
+            # The weight cast cache is disabled since it is incompatible with jit tracing.
+            autocast = torch.autocast(x.device.type, dtype=torch.bfloat16, cache_enabled=False)
+        else:
+            autocast = None
         losses = []
         for epoch in range(num_epochs):
             for x, t, y in dataloader:
                 x = self.whiten(x)
-                loss = svi.step(x, t, y, size=len(dataset)) / len(dataset)
+                with optional(autocast, amp):
+                    loss = svi.step(x, t, y, size=len(dataset)) / len(dataset)
                 logger.debug("step {: >5d} loss = {:0.6g}".format(len(losses), loss))
                 assert not torch_isnan(loss)
                 losses.append(loss)
@@ -552,7 +693,7 @@ class CEVAE(nn.Module):
             ITE(x) = \mathbb E\bigl[ \mathbf y \mid \mathbf X=x, do(\mathbf t=1) \bigr]
                    - \mathbb E\bigl[ \mathbf y \mid \mathbf X=x, do(\mathbf t=0) \bigr]
 
-        This has complexity ``O(len(x) * num_samples ** 2)``.
+        This has complexity ``O(len(x) * num_samples)``.
 
         :param ~torch.Tensor x: A batch of data.
         :param int num_samples: The number of monte carlo samples.
@@ -571,13 +712,15 @@ class CEVAE(nn.Module):
         result = []
         for x in dataloader:
             x = self.whiten(x)
-            with pyro.plate("num_particles", num_samples, dim=-2):
-                with poutine.trace() as tr, poutine.block(hide=["y", "t"]):
-                    self.guide(x)
-                with poutine.do(data=dict(t=torch.zeros(()))):
-                    y0 = poutine.replay(self.model.y_mean, tr.trace)(x)
-                with poutine.do(data=dict(t=torch.ones(()))):
-                    y1 = poutine.replay(self.model.y_mean, tr.trace)(x)
+            # Sample from the guide directly rather than tracing it, drawing
+            # num_samples particles of z for each sample of t and y.
+            t = self.guide.t_dist(x).sample()
+            y = self.guide.y_dist(t, x).sample()
+            z = self.guide.z_dist(y, t, x).sample([num_samples])
+            # Since y depends on x only through z, we compute the expected
+            # outcome directly, for both t values at once via a batch dim.
+            t = x.new_tensor([0., 1.]).reshape(2, 1, 1)
+            y0, y1 = self.model.y_dist(t, z).mean.unbind(0)
             ite = (y1 - y0).mean(0)
             if not torch._C._get_tracing_state():
                 logger.debug("batch ate = {:0.6g}".format(ite.mean()))
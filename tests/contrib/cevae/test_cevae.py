@@ -1,4 +1,5 @@
 import io
+import math
 import warnings
 
 import pytest
@@ -24,16 +25,59 @@ def generate_data(num_data, feature_dim):
 @pytest.mark.parametrize("num_data", [1, 100, 200])
 @pytest.mark.parametrize("feature_dim", [1, 2])
 @pytest.mark.parametrize("outcome_dist", DIST_NETS)
-def test_smoke(num_data, feature_dim, outcome_dist):
+@pytest.mark.parametrize("jit", [False, True], ids=["python", "jit"])
+def test_smoke(jit, num_data, feature_dim, outcome_dist):
     x, t, y = generate_data(num_data, feature_dim)
     if outcome_dist == "exponential":
         y.clamp_(min=1e-20)
     cevae = CEVAE(feature_dim, outcome_dist)
-    cevae.fit(x, t, y, num_epochs=2)
+    cevae.fit(x, t, y, num_epochs=2, batch_size=64, jit_compile=jit)
     ite = cevae.ite(x)
     assert ite.shape == (num_data,)
 
 
+def test_num_workers():
+    x, t, y = generate_data(num_data=50, feature_dim=2)
+    cevae = CEVAE(feature_dim=2, hidden_dim=8)
+    losses = cevae.fit(x, t, y, num_epochs=2, batch_size=20, num_workers=1)
+    assert len(losses) == 6
+    assert all(math.isfinite(loss) for loss in losses)
+
+
+@pytest.mark.parametrize("outcome_dist", DIST_NETS)
+def test_fit_updates_all_params(outcome_dist):
+    x, t, y = generate_data(num_data=32, feature_dim=2)
+    if outcome_dist == "exponential":
+        y.clamp_(min=1e-20)
+    cevae = CEVAE(feature_dim=2, outcome_dist=outcome_dist, hidden_dim=8)
+    init_params = {name: value.detach().clone()
+                   for name, value in cevae.named_parameters()}
+    cevae.fit(x, t, y, num_epochs=1, batch_size=32)
+    for name, value in cevae.named_parameters():
+        assert name.startswith(("model.", "guide."))
+        assert not torch.equal(value, init_params[name]), name
+
+
+@pytest.mark.skipif(not hasattr(torch, "autocast"), reason="requires torch.autocast")
+@pytest.mark.parametrize("jit", [False, True], ids=["python", "jit"])
+def test_amp(jit):
+    x, t, y = [v.float() for v in generate_data(num_data=100, feature_dim=2)]
+    cevae = CEVAE(feature_dim=2, hidden_dim=32).float()
+    losses = cevae.fit(x, t, y, num_epochs=2, batch_size=32, jit_compile=jit, amp=True)
+    assert len(losses) == 8
+    assert all(math.isfinite(loss) for loss in losses)
+    for value in cevae.parameters():
+        assert value.dtype == torch.float32
+
+    z = torch.randn(10, 20, dtype=torch.float32)
+    with torch.autocast("cpu", dtype=torch.bfloat16):
+        loc, scale = cevae.model.x_nn(z)
+    assert loc.dtype == torch.bfloat16
+
+    ite = cevae.ite(x)
+    assert ite.shape == (100,)
+
+
 @pytest.mark.parametrize("feature_dim", [1, 2])
 @pytest.mark.parametrize("outcome_dist", DIST_NETS)
 @pytest.mark.parametrize("jit", [False, True], ids=["python", "jit"])